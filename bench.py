@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+OCR-SoM 流水线基准测试
+
+在不同分辨率、不同元素密度的合成截图上分别计时各阶段，输出 p50/p95 延迟、
+吞吐量和峰值内存，并可保存为 JSON 供回归对比。全程离线、只用 CPU。
+
+阶段:
+  - ocr:              ocr_som.run_ocr
+  - contours_cli:     ocr_som.detect_ui_contours
+  - contours_server:  server.detect_ui_contours
+  - merge:            ocr_som.merge_elements
+  - draw_cli:         ocr_som.draw_som_marks (PIL)
+  - draw_server:      server.draw_som_marks (OpenCV)
+
+使用方法:
+  python bench.py --stub-ocr                      # 用桩 OCR，只测非 OCR 阶段的真实耗时
+  python bench.py --repeat 10 --json bench.json   # 保存结果
+  python bench.py --stub-ocr --compare bench.json # 与之前的结果对比 p50
+  python bench.py --sizes 1920x1080 --densities dense --stages contours_server draw_server
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import ocr_som
+import server
+from som_core import run_ocr_batch
+
+STAGES = ("ocr", "contours_cli", "contours_server", "merge", "draw_cli", "draw_server")
+
+DEFAULT_SIZES = ("1280x800", "1920x1080", "2880x1800", "3840x2160")
+
+# 每百万逻辑像素的文字行数 / 图标数
+DENSITIES = {
+    "sparse": (15, 8),
+    "normal": (45, 20),
+    "dense": (120, 50),
+}
+
+WORDS = ("File", "Edit", "View", "Settings", "Search", "Open", "Save", "Cancel", "OK",
+         "Downloads", "Documents", "Recent", "Share", "Export", "Preview", "Help")
+
+
+# ---------------------------------------------------------------------------
+# 合成截图
+# ---------------------------------------------------------------------------
+
+def make_screenshot(width, height, density="normal", seed=0):
+    """
+    生成合成截图：标题栏、侧边栏、按钮、彩色图标和文字行，
+    元素数量按逻辑面积（除去 HiDPI 缩放）和密度换算，同样参数生成的图片完全相同
+    """
+    rng = np.random.default_rng(seed)
+    text_per_mp, icons_per_mp = DENSITIES[density]
+    ui = max(1.0, min(width, height) / 800)  # HiDPI 缩放
+    megapixels = width * height / ui ** 2 / 1e6
+
+    img = np.full((height, width, 3), 245, np.uint8)
+    bar_h = int(36 * ui)
+    side_w = int(220 * ui)
+    cv2.rectangle(img, (0, 0), (width, bar_h), (225, 225, 225), -1)
+    cv2.rectangle(img, (0, bar_h), (side_w, height), (235, 235, 238), -1)
+
+    font_scale = 0.5 * ui
+    thickness = max(1, int(round(ui)))
+
+    def put_text(x, y):
+        text = " ".join(rng.choice(WORDS, size=int(rng.integers(1, 4))))
+        cv2.putText(img, text, (int(x), int(y)), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (30, 30, 30),
+                    thickness, cv2.LINE_AA)
+
+    # 标题栏菜单和侧边栏条目
+    for i, x in enumerate(range(int(12 * ui), width - int(120 * ui), int(90 * ui))):
+        if i >= 8:
+            break
+        put_text(x, bar_h * 0.7)
+    for y in range(bar_h + int(40 * ui), height - int(20 * ui), int(36 * ui)):
+        put_text(16 * ui, y)
+
+    # 按钮
+    n_buttons = max(1, int(icons_per_mp * megapixels / 2))
+    for _ in range(n_buttons):
+        w, h = int(rng.integers(80, 160) * ui), int(28 * ui)
+        x = int(rng.integers(side_w, max(side_w + 1, width - w)))
+        y = int(rng.integers(bar_h, max(bar_h + 1, height - h)))
+        cv2.rectangle(img, (x, y), (x + w, y + h), (180, 180, 180), thickness)
+        put_text(x + 8 * ui, y + h * 0.7)
+
+    # 彩色图标
+    n_icons = max(1, int(icons_per_mp * megapixels))
+    for _ in range(n_icons):
+        s = int(rng.integers(20, 48) * ui)
+        x = int(rng.integers(side_w, max(side_w + 1, width - s)))
+        y = int(rng.integers(bar_h, max(bar_h + 1, height - s)))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        if rng.random() < 0.5:
+            cv2.rectangle(img, (x, y), (x + s, y + s), color, -1)
+        else:
+            cv2.circle(img, (x + s // 2, y + s // 2), s // 2, color, -1)
+
+    # 正文文字行
+    n_text = max(1, int(text_per_mp * megapixels))
+    for _ in range(n_text):
+        x = rng.integers(side_w + 10, max(side_w + 11, width - int(260 * ui)))
+        y = rng.integers(bar_h + int(20 * ui), height - int(8 * ui))
+        put_text(x, y)
+
+    return img
+
+
+# ---------------------------------------------------------------------------
+# 桩 OCR
+# ---------------------------------------------------------------------------
+
+class _StubDetector:
+    """形态学文字检测：暗色像素横向膨胀后取外接矩形，耗时与真实模型无关"""
+
+    def __call__(self, img):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        _, mask = cv2.threshold(gray, 100, 255, cv2.THRESH_BINARY_INV)
+        mask = cv2.dilate(mask, np.ones((3, 15), np.uint8))
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        boxes = []
+        for cnt in contours:
+            x, y, w, h = cv2.boundingRect(cnt)
+            if w >= 8 and h >= 6:
+                boxes.append([[x, y], [x + w, y], [x + w, y + h], [x, y + h]])
+        return np.asarray(boxes, dtype=np.float32).reshape(-1, 4, 2), 0.0
+
+
+class _StubClassifier:
+    def __call__(self, crops):
+        return crops, [["0", 1.0] for _ in crops], 0.0
+
+
+class _StubRecognizer:
+    def __call__(self, crops):
+        return [(f"text{crop.shape[1]}x{crop.shape[0]}", 0.99) for crop in crops], 0.0
+
+
+class StubOCR:
+    """
+    与 PaddleOCR 2.7 接口一致的桩引擎（ocr() 和分阶段属性），
+    用于单独测量 OCR 以外各阶段的耗时
+    """
+
+    def __init__(self, use_angle_cls=True):
+        self.use_angle_cls = use_angle_cls
+        self.drop_score = 0.5
+        self.text_detector = _StubDetector()
+        self.text_classifier = _StubClassifier() if use_angle_cls else None
+        self.text_recognizer = _StubRecognizer()
+
+    def ocr(self, img, cls=True):
+        if not isinstance(img, np.ndarray):
+            img = cv2.imread(str(img))
+        lines = run_ocr_batch(self, [img], cls=cls and self.use_angle_cls)[0]
+        return [lines]
+
+
+# ---------------------------------------------------------------------------
+# 计时
+# ---------------------------------------------------------------------------
+
+def peak_rss_mb():
+    """
+    进程峰值常驻内存 (MB)，不支持的平台返回 None
+
+    ru_maxrss 只增不减，所有用例跑在同一进程里，只能反映整次运行的峰值（不按用例统计）。
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize(samples_ms):
+    arr = np.asarray(samples_ms, dtype=np.float64)
+    total = arr.sum()
+    return {
+        "runs": len(arr),
+        "p50_ms": round(float(np.percentile(arr, 50)), 2),
+        "p95_ms": round(float(np.percentile(arr, 95)), 2),
+        "mean_ms": round(float(arr.mean()), 2),
+        "throughput_per_s": round(len(arr) / (total / 1000), 2) if total > 0 else None,
+    }
+
+
+def time_call(fn, repeat, warmup=1):
+    """先预热再重复调用，返回 (最后一次结果, 每次耗时 ms 列表)"""
+    result = None
+    for _ in range(warmup):
+        result = fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return result, samples
+
+
+def run_case(ocr, path, img, stages, repeat, out_dir):
+    """对一张截图依次运行各阶段，返回 {阶段: 耗时列表}"""
+    timings = {}
+    quiet = StringIO()
+
+    def measure(stage, fn):
+        if stage not in stages:
+            return fn() if stage in ("ocr", "contours_cli", "merge") else None
+        result, samples = time_call(fn, repeat)
+        timings[stage] = samples
+        return result
+
+    # 后续阶段需要前面阶段的输出，未选中的阶段只运行一次不计时
+    ocr_elements = measure("ocr", lambda: ocr_som.run_ocr(ocr, path))
+    ui_elements = measure("contours_cli", lambda: ocr_som.detect_ui_contours(path))
+    measure("contours_server", lambda: server.detect_ui_contours(img))
+    elements = measure("merge", lambda: ocr_som.merge_elements(ocr_elements, ui_elements))
+
+    marked_path = out_dir / f"{path.stem}_marked.png"
+
+    def draw_cli():
+        with redirect_stdout(quiet):
+            return ocr_som.draw_som_marks(str(path), elements, str(marked_path))
+
+    measure("draw_cli", draw_cli)
+    measure("draw_server", lambda: server.draw_som_marks(img, elements))
+    return timings, len(elements)
+
+
+def compare(results, baseline_path):
+    """打印与基线 JSON 的 p50 对比"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    base_cases = {(c["size"], c["density"]): c for c in baseline.get("cases", [])}
+    print(f"\n与基线对比 ({baseline_path})，p50 比值 <1 表示更快:")
+    for case in results["cases"]:
+        base = base_cases.get((case["size"], case["density"]))
+        if base is None:
+            continue
+        parts = []
+        for stage, stats in case["stages"].items():
+            old = base["stages"].get(stage)
+            if old and old["p50_ms"] > 0:
+                parts.append(f"{stage}={stats['p50_ms'] / old['p50_ms']:.2f}x")
+        print(f"  {case['size']:>10} {case['density']:<7} " + " ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCR-SoM 流水线基准测试")
+    parser.add_argument("--stub-ocr", action="store_true", help="使用桩 OCR（不加载 PaddleOCR）")
+    parser.add_argument("--sizes", nargs="+", default=list(DEFAULT_SIZES), help="分辨率，如 1920x1080")
+    parser.add_argument("--densities", nargs="+", default=list(DENSITIES), choices=list(DENSITIES),
+                        help="元素密度")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES, help="计时的阶段")
+    parser.add_argument("--repeat", type=int, default=5, help="每个阶段重复次数")
+    parser.add_argument("--seed", type=int, default=0, help="合成截图随机种子")
+    parser.add_argument("--json", dest="json_path", help="保存 JSON 结果的路径")
+    parser.add_argument("--compare", help="与之前保存的 JSON 结果对比")
+    args = parser.parse_args()
+
+    if args.stub_ocr:
+        ocr = StubOCR()
+    else:
+        print("加载 PaddleOCR...")
+        try:
+            with redirect_stdout(StringIO()):
+                ocr = ocr_som.load_paddleocr()
+        except ImportError:
+            print("未安装 PaddleOCR，可使用 --stub-ocr 只测量非 OCR 阶段")
+            sys.exit(1)
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+            "stub_ocr": args.stub_ocr,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "cases": [],
+    }
+    stage_samples = {stage: [] for stage in args.stages}
+
+    with tempfile.TemporaryDirectory(prefix="som-bench-") as tmp:
+        out_dir = Path(tmp)
+        for size in args.sizes:
+            width, height = (int(v) for v in size.lower().split("x"))
+            for density in args.densities:
+                img = make_screenshot(width, height, density, seed=args.seed)
+                path = out_dir / f"{width}x{height}_{density}.png"
+                cv2.imwrite(str(path), img)
+
+                timings, count = run_case(ocr, path, img, args.stages, args.repeat, out_dir)
+                case = {
+                    "size": size,
+                    "density": density,
+                    "elements": count,
+                    "stages": {stage: summarize(samples) for stage, samples in timings.items()},
+                }
+                results["cases"].append(case)
+                for stage, samples in timings.items():
+                    stage_samples[stage].extend(samples)
+
+                line = " ".join(f"{s}={v['p50_ms']:.1f}/{v['p95_ms']:.1f}" for s, v in case["stages"].items())
+                print(f"{size:>10} {density:<7} {count:4d} 个元素  p50/p95(ms): {line}")
+
+    results["stages"] = {stage: summarize(samples) for stage, samples in stage_samples.items() if samples}
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    print("\n汇总（所有截图）:")
+    for stage, stats in results["stages"].items():
+        print(f"  {stage:<16} p50={stats['p50_ms']:8.2f}ms  p95={stats['p95_ms']:8.2f}ms  "
+              f"吞吐={stats['throughput_per_s']}/s")
+    print(f"  峰值内存: {results['peak_rss_mb']} MB")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"已保存: {args.json_path}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+轮廓检测缩放精度检查
+
+在原图和缩小后的图片上分别做轮廓检测，以原图结果为基准统计召回率/精确率
+（IoU > 0.5 视为匹配）和耗时，用于确认 contour_scale 的取值。
+
+使用方法:
+  python check_contour_scale.py                    # 检查 demo/*.png
+  python check_contour_scale.py a.png b.png        # 检查指定图片
+  python check_contour_scale.py --scales 0.5 0.75  # 指定缩放比例
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+from server import detect_ui_contours, load_image, snap_contour_scale
+from som_core import overlap_matrix
+
+IOU_THRESHOLD = 0.5
+
+
+def timed_contours(image, scale, repeat):
+    """重复检测取最短耗时，返回 (框列表, 毫秒)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        elements = detect_ui_contours(image, scale=scale)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return [el["box"] for el in elements], best
+
+
+def match_stats(reference, boxes):
+    """以原图结果为基准计算 (召回率, 精确率)"""
+    if not reference or not boxes:
+        return float(not reference), float(not boxes)
+    iou = overlap_matrix(reference, boxes)
+    recall = float((iou.max(axis=1) > IOU_THRESHOLD).mean())
+    precision = float((iou.max(axis=0) > IOU_THRESHOLD).mean())
+    return recall, precision
+
+
+def main():
+    parser = argparse.ArgumentParser(description="轮廓检测缩放精度检查")
+    parser.add_argument("images", nargs="*", help="图片路径 (默认 demo/*.png)")
+    parser.add_argument("--scales", type=float, nargs="+", default=[0.5, 0.75], help="缩放比例")
+    parser.add_argument("--repeat", type=int, default=3, help="每个比例重复次数 (取最短耗时)")
+    args = parser.parse_args()
+
+    paths = args.images or sorted(str(p) for p in (Path(__file__).parent / "demo").glob("*.png"))
+    for path in paths:
+        image = load_image(path)
+        if image is None:
+            print(f"{path}: 无法读取")
+            continue
+        h, w = image.shape[:2]
+        reference, full_ms = timed_contours(image, 1.0, args.repeat)
+        print(f"{path} ({w}x{h}) 原图: {len(reference)} 个轮廓, {full_ms:.1f}ms")
+        for scale in args.scales:
+            boxes, ms = timed_contours(image, scale, args.repeat)
+            recall, precision = match_stats(reference, boxes)
+            actual = snap_contour_scale(scale)
+            label = f"scale={scale:g}" + (f" (按 {actual:g} 检测)" if actual != scale else "")
+            print(f"  {label}: {len(boxes)} 个轮廓, {ms:.1f}ms, "
+                  f"召回率={recall:.3f}, 精确率={precision:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,12 +12,20 @@ OCR + SoM (Set-of-Mark) 视觉标注方案
 
 示例：
   python ocr_som.py screenshot.png marked.png elements.json
+
+在 Python 中直接调用（不落盘）：
+  from ocr_som import SoMEngine
+  engine = SoMEngine()
+  result = engine.run(screenshot)   # numpy BGR 数组 / PIL.Image / 图片字节 / 路径
 """
 
 import sys
 import json
 import os
+import functools
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import List, Optional
 
 # 设置环境变量，禁用 GPU 和 oneDNN
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
@@ -28,13 +36,18 @@ import cv2
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
+from som_core import (
+    TEXT, TILE_AUTO_SIDE, ElementTable, MarkRenderer, RecognitionCache, as_bgr_image, run_ocr_batch,
+    run_ocr_tiled, suppress_covered,
+)
+
 
-def load_paddleocr():
-    """延迟加载 PaddleOCR（首次加载较慢）"""
+def load_paddleocr(use_angle_cls=True):
+    """延迟加载 PaddleOCR（首次加载较慢），use_angle_cls=False 时不加载方向分类模型"""
     from paddleocr import PaddleOCR
     # PaddleOCR 2.7.x API
     ocr = PaddleOCR(
-        use_angle_cls=True,
+        use_angle_cls=use_angle_cls,
         use_gpu=False,
         lang='ch',
         show_log=False,
@@ -42,41 +55,69 @@ def load_paddleocr():
     return ocr
 
 
-def run_ocr(ocr, image_path):
+def run_ocr(ocr, image, tile=None, cls=True, rec=True, rec_cache=None):
     """
     运行 OCR 识别
+    image: 图片路径、BGR 数组、PIL.Image 或图片字节
+    tile: 是否切成重叠块分别识别，None 表示长边超过 4096 时自动分块
+    cls: 是否做方向分类；rec: 是否识别文字（False 时只返回文字框，text 为空）
+    rec_cache: RecognitionCache，跳过识别过的文字切片（连续处理相似截图时使用）
     返回: [(text, confidence, [[x1,y1], [x2,y2], [x3,y3], [x4,y4]]), ...]
     """
-    result = ocr.ocr(str(image_path), cls=True)
+    table = ocr_table(ocr, image, tile=tile, cls=cls, rec=rec, rec_cache=rec_cache)
+    return [
+        {
+            'text': text,
+            'confidence': None if np.isnan(confidence) else confidence,
+            'box': box,
+            'polygon': polygon,
+        }
+        for text, confidence, box, polygon in zip(
+            table.texts, table.confidences.tolist(), table.boxes.tolist(), table.polygons.tolist(),
+        )
+    ]
+
+
+def ocr_table(ocr, image, tile=None, cls=True, rec=True, rec_cache=None):
+    """运行 OCR 识别，参数同 run_ocr，返回文字元素表（ElementTable，合并和绘制直接使用）"""
+    img = as_bgr_image(image)
+    if img is None:
+        return ElementTable.from_ocr_lines(None)
+    if tile is None:
+        tile = max(img.shape[:2]) > TILE_AUTO_SIDE
     
-    elements = []
-    if result and result[0]:
-        for line in result[0]:
-            box = line[0]  # 四个角点坐标
-            text = line[1][0]  # 文字内容
-            confidence = line[1][1]  # 置信度
-            
-            # 计算边界框
-            x_coords = [p[0] for p in box]
-            y_coords = [p[1] for p in box]
-            x1, y1 = min(x_coords), min(y_coords)
-            x2, y2 = max(x_coords), max(y_coords)
-            
-            elements.append({
-                'text': text,
-                'confidence': float(confidence),
-                'box': [int(x1), int(y1), int(x2), int(y2)],
-                'polygon': [[int(p[0]), int(p[1])] for p in box],
-            })
+    if tile:
+        lines = run_ocr_tiled(lambda crops: run_ocr_batch(ocr, crops, cls=cls, rec=rec, rec_cache=rec_cache), img)
+    elif not (cls and rec) or rec_cache is not None:
+        lines = run_ocr_batch(ocr, [img], cls=cls, rec=rec, rec_cache=rec_cache)[0]
+    else:
+        result = ocr.ocr(img, cls=True)
+        lines = result[0] if result else None
     
-    return elements
+    return ElementTable.from_ocr_lines(lines)
 
 
-def detect_ui_contours(image_path, min_area=500, max_area=100000):
+def detect_ui_contours(image, min_area=500, max_area=100000):
     """
     使用 OpenCV 检测 UI 元素轮廓（按钮、图标等）
+    image: 图片路径、BGR 数组、PIL.Image 或图片字节
     """
-    img = cv2.imread(str(image_path))
+    return [
+        {'type': 'ui_element', 'box': box, 'area': area}
+        for box, area in find_ui_contours(image, min_area, max_area)
+    ]
+
+
+def contour_table(image, min_area=500, max_area=100000):
+    """检测 UI 元素轮廓，参数同 detect_ui_contours，返回轮廓元素表（ElementTable）"""
+    return ElementTable.contours([box for box, _ in find_ui_contours(image, min_area, max_area)])
+
+
+def find_ui_contours(image, min_area=500, max_area=100000):
+    """返回 UI 元素轮廓的 [(box, area), ...]，box 为 [左, 上, 右, 下]"""
+    img = as_bgr_image(image)
+    if img is None:
+        return []
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     
     # 边缘检测
@@ -97,11 +138,7 @@ def detect_ui_contours(image_path, min_area=500, max_area=100000):
             # 过滤掉太扁或太窄的
             aspect_ratio = w / h if h > 0 else 0
             if 0.1 < aspect_ratio < 10:
-                ui_elements.append({
-                    'type': 'ui_element',
-                    'box': [x, y, x + w, y + h],
-                    'area': area,
-                })
+                ui_elements.append(([x, y, x + w, y + h], area))
     
     return ui_elements
 
@@ -109,120 +146,228 @@ def detect_ui_contours(image_path, min_area=500, max_area=100000):
 def merge_elements(ocr_elements, ui_elements):
     """
     合并 OCR 文字和 UI 轮廓，去重
+    ocr_elements / ui_elements: run_ocr / detect_ui_contours 返回的 dict 列表
     """
-    all_elements = []
-    
-    # 先添加 OCR 元素（优先级更高）
-    for i, el in enumerate(ocr_elements):
-        all_elements.append({
-            'id': len(all_elements),
-            'type': 'text',
-            'text': el['text'],
-            'confidence': el['confidence'],
-            'box': el['box'],
-        })
-    
-    # 添加不与 OCR 元素重叠的 UI 元素
-    for ui_el in ui_elements:
-        ui_box = ui_el['box']
-        is_overlapping = False
-        
-        for ocr_el in ocr_elements:
-            ocr_box = ocr_el['box']
-            # 检查重叠
-            if (ui_box[0] < ocr_box[2] and ui_box[2] > ocr_box[0] and
-                ui_box[1] < ocr_box[3] and ui_box[3] > ocr_box[1]):
-                # 计算重叠面积
-                overlap_x = min(ui_box[2], ocr_box[2]) - max(ui_box[0], ocr_box[0])
-                overlap_y = min(ui_box[3], ocr_box[3]) - max(ui_box[1], ocr_box[1])
-                overlap_area = overlap_x * overlap_y
-                ui_area = (ui_box[2] - ui_box[0]) * (ui_box[3] - ui_box[1])
-                if overlap_area > ui_area * 0.3:  # 30% 以上重叠则认为是同一元素
-                    is_overlapping = True
-                    break
-        
-        if not is_overlapping:
-            all_elements.append({
-                'id': len(all_elements),
-                'type': 'icon',
-                'text': '',
-                'box': ui_box,
-            })
-    
-    return all_elements
+    texts = ElementTable(
+        [el['box'] for el in ocr_elements],
+        confidences=[np.nan if el['confidence'] is None else el['confidence'] for el in ocr_elements],
+        texts=[el['text'] for el in ocr_elements],
+    )
+    contours = ElementTable.contours([ui_el['box'] for ui_el in ui_elements])
+    return element_dicts(merge_tables(texts, contours))
 
 
-def draw_som_marks(image_path, elements, output_path):
+def merge_tables(texts, contours, threshold=0.3):
     """
-    在图片上绘制 SoM 标记（带编号的彩色框）
+    合并文字表和轮廓表：丢弃超过 threshold 的面积被文字覆盖的轮廓（视为同一元素），
+    文字在前、轮廓在后重新编号
     """
-    # 使用 PIL 绘制（支持中文）
-    img = Image.open(image_path)
-    draw = ImageDraw.Draw(img)
-    
-    # 尝试加载字体
-    try:
-        # Windows 中文字体
-        font = ImageFont.truetype("msyh.ttc", 16)
-        font_small = ImageFont.truetype("msyh.ttc", 12)
-    except:
-        try:
-            font = ImageFont.truetype("arial.ttf", 16)
-            font_small = ImageFont.truetype("arial.ttf", 12)
-        except:
-            font = ImageFont.load_default()
-            font_small = font
-    
-    # 颜色列表（循环使用）
-    colors = [
-        (255, 0, 0),      # 红
-        (0, 255, 0),      # 绿
-        (0, 0, 255),      # 蓝
-        (255, 165, 0),    # 橙
-        (128, 0, 255),    # 紫
-        (0, 255, 255),    # 青
-        (255, 0, 255),    # 品红
-        (255, 255, 0),    # 黄
-    ]
-    
-    for el in elements:
-        idx = el['id']
-        box = el['box']
-        color = colors[idx % len(colors)]
-        
-        x1, y1, x2, y2 = box
-        
-        # 绘制矩形框
-        draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
-        
-        # 绘制编号标签背景
-        label = str(idx)
-        label_bbox = font.getbbox(label)
-        label_w = label_bbox[2] - label_bbox[0] + 6
-        label_h = label_bbox[3] - label_bbox[1] + 4
-        
-        # 标签位置（左上角）
-        label_x = max(0, x1)
-        label_y = max(0, y1 - label_h - 2)
-        if label_y < 0:
-            label_y = y1 + 2
-        
-        # 绘制标签背景
-        draw.rectangle(
-            [label_x, label_y, label_x + label_w, label_y + label_h],
-            fill=color
-        )
-        
-        # 绘制编号文字
-        draw.text((label_x + 3, label_y + 2), label, fill=(255, 255, 255), font=font)
-    
-    # 保存图片
+    covered = suppress_covered(contours.boxes, texts.boxes, threshold=threshold)
+    merged = ElementTable.concat([texts, contours.take(~covered)])
+    merged.ids = np.arange(len(merged), dtype=np.int32)
+    return merged
+
+
+def element_dicts(table):
+    """元素表转为输出用的 dict 列表（文字含 confidence，轮廓的 type 为 'icon'）"""
+    ids = table.ids.tolist()
+    boxes = table.boxes.tolist()
+    confidences = table.confidences.tolist()
+    elements = []
+    for i, is_text in enumerate(table.is_text.tolist()):
+        if is_text:
+            confidence = None if np.isnan(confidences[i]) else confidences[i]
+            elements.append({'id': ids[i], 'type': 'text', 'text': table.texts[i], 'confidence': confidence,
+                             'box': boxes[i]})
+        else:
+            elements.append({'id': ids[i], 'type': 'icon', 'text': '', 'box': boxes[i]})
+    return elements
+
+
+def draw_som_marks(image, elements, output_path):
+    """
+    在图片上绘制 SoM 标记（带编号的彩色框）并保存
+    image: 图片路径、BGR 数组、PIL.Image 或图片字节
+    """
+    img = render_som_marks(image, elements)
     img.save(output_path)
     print(f"已保存标注图片: {output_path}")
     
     return str(output_path)
 
 
+# 标注颜色（RGB，按编号循环使用）
+MARK_COLORS = [
+    (255, 0, 0),      # 红
+    (0, 255, 0),      # 绿
+    (0, 0, 255),      # 蓝
+    (255, 165, 0),    # 橙
+    (128, 0, 255),    # 紫
+    (0, 255, 255),    # 青
+    (255, 0, 255),    # 品红
+    (255, 255, 0),    # 黄
+]
+
+
+@functools.lru_cache(maxsize=None)
+def load_label_font(size=16):
+    """加载编号字体（只加载一次）：Windows 中文字体，其次 Arial，都没有时用 PIL 默认字体"""
+    for name in ("msyh.ttc", "arial.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            pass
+    return ImageFont.load_default()
+
+
+def truetype_label(label):
+    """用 PIL 字体渲染编号，返回 uint8 覆盖度掩码（左右留 3px、上下留 2px 边距）"""
+    font = load_label_font()
+    left, top, right, bottom = font.getbbox(label)
+    mask = Image.new("L", (right - left + 7, bottom - top + 5))
+    ImageDraw.Draw(mask).text((3 - left, 2 - top), label, fill=255, font=font)
+    return np.asarray(mask)
+
+
+# 编号标签 sprite 跨调用复用
+_mark_renderer = MarkRenderer(MARK_COLORS, render_label=truetype_label)
+
+
+def render_som_marks(image, elements):
+    """绘制 SoM 标记，返回新的 PIL.Image（不修改输入）；elements 为 ElementTable 或元素 dict 列表"""
+    if isinstance(image, Image.Image):
+        rgb = np.array(image.convert("RGB"))
+    else:
+        img = as_bgr_image(image)
+        if img is None:
+            raise ValueError(f"无法读取图片: {image}" if isinstance(image, (str, os.PathLike)) else "图片无法解码")
+        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    
+    if isinstance(elements, ElementTable):
+        _mark_renderer.draw(rgb, elements.ids, elements.boxes)
+    else:
+        _mark_renderer.draw(rgb, [el['id'] for el in elements], [el['box'] for el in elements])
+    return Image.fromarray(rgb)
+
+
+@dataclass
+class SoMElement:
+    """一个标注元素，box 为 [左, 上, 右, 下]"""
+    id: int
+    type: str                          # 'text'（OCR 文字）或 'icon'（UI 轮廓）
+    box: List[int]
+    text: str = ''
+    confidence: Optional[float] = None
+
+    @property
+    def center(self):
+        """中心点坐标 (x, y)，用于点击"""
+        x1, y1, x2, y2 = self.box
+        return (x1 + x2) // 2, (y1 + y2) // 2
+
+    def to_dict(self):
+        d = {'id': self.id, 'type': self.type, 'text': self.text, 'box': list(self.box)}
+        if self.type == 'text':
+            d['confidence'] = self.confidence
+        return d
+
+
+@dataclass
+class SoMResult:
+    """SoMEngine.run 的结果；marked 为标注后的 BGR 数组（draw=False 时为 None）"""
+    elements: List[SoMElement]
+    width: int
+    height: int
+    marked: Optional[np.ndarray] = field(default=None, repr=False)
+
+    @classmethod
+    def from_table(cls, table, width, height, marked=None):
+        """由合并后的元素表构造（文字元素为 'text'，轮廓为 'icon'）"""
+        elements = [
+            SoMElement(
+                id=element_id,
+                type='text' if element_type == TEXT else 'icon',
+                box=box,
+                text=text,
+                confidence=None if np.isnan(confidence) else confidence,
+            )
+            for element_id, element_type, box, text, confidence in zip(
+                table.ids.tolist(), table.types.tolist(), table.boxes.tolist(), table.texts,
+                table.confidences.tolist(),
+            )
+        ]
+        return cls(elements=elements, width=width, height=height, marked=marked)
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __getitem__(self, element_id):
+        """按编号取元素"""
+        for el in self.elements:
+            if el.id == element_id:
+                return el
+        raise KeyError(element_id)
+
+    def find_text(self, text):
+        """返回文字包含 text 的元素"""
+        return [el for el in self.elements if el.type == 'text' and text in el.text]
+
+    def to_dict(self):
+        return {
+            'width': self.width,
+            'height': self.height,
+            'count': len(self.elements),
+            'elements': [el.to_dict() for el in self.elements],
+        }
+
+
+class SoMEngine:
+    """
+    进程内调用的 SoM 引擎
+
+    持有加载好的 PaddleOCR 模型（只加载一次），直接处理内存中的截图，
+    不需要先写入磁盘再读回。
+
+    用法:
+        engine = SoMEngine()
+        result = engine.run(frame, draw=False)   # frame: BGR/BGRA 数组、PIL.Image、图片字节或路径
+        el = result.find_text("确定")[0]
+        click(*el.center)
+    """
+
+    def __init__(self, ocr=None, use_angle_cls=True, min_area=500, max_area=100000, rec_cache_size=16 << 20):
+        """
+        ocr: 已加载的 PaddleOCR 实例（可复用），None 时自动加载
+        rec_cache_size: 文字识别缓存上限（字节），连续帧中未变化的文字不再重复识别，0 为关闭
+        """
+        self.ocr = ocr if ocr is not None else load_paddleocr(use_angle_cls=use_angle_cls)
+        self.min_area = min_area
+        self.max_area = max_area
+        self.rec_cache = RecognitionCache(rec_cache_size) if rec_cache_size else None
+
+    def run(self, image, draw=True, detect_contours=True, tile=None, cls=True, rec=True):
+        """
+        识别并编号截图中的元素
+
+        draw: 是否绘制标注图（不需要时关闭可省去绘制开销）
+        detect_contours: 是否检测 UI 轮廓，False 时只返回 OCR 文字
+        tile / cls / rec: 同 run_ocr
+        """
+        img = as_bgr_image(image)
+        if img is None:
+            raise ValueError("图片无法解码")
+
+        texts = ocr_table(self.ocr, img, tile=tile, cls=cls, rec=rec, rec_cache=self.rec_cache)
+        contours = contour_table(img, self.min_area, self.max_area) if detect_contours else ElementTable.contours([])
+        merged = merge_tables(texts, contours)
+
+        marked = None
+        if draw:
+            marked = cv2.cvtColor(np.asarray(render_som_marks(img, merged)), cv2.COLOR_RGB2BGR)
+
+        return SoMResult.from_table(merged, width=img.shape[1], height=img.shape[0], marked=marked)
+
+
 def main():
     if len(sys.argv) < 2:
         print(__doc__)
@@ -246,23 +391,24 @@ def main():
     
     # 2. Run OCR
     print("\n[2/4] Running OCR...")
-    ocr_elements = run_ocr(ocr, input_image)
-    print(f"  Found {len(ocr_elements)} text elements")
+    texts = ocr_table(ocr, input_image)
+    print(f"  Found {len(texts)} text elements")
     
     # 3. Detect UI contours
     print("\n[3/4] Detecting UI contours...")
-    ui_elements = detect_ui_contours(input_image)
-    print(f"  Found {len(ui_elements)} UI elements")
+    contours = contour_table(input_image)
+    print(f"  Found {len(contours)} UI elements")
     
     # 4. Merge elements
-    all_elements = merge_elements(ocr_elements, ui_elements)
-    print(f"  Total {len(all_elements)} elements after merge")
+    merged = merge_tables(texts, contours)
+    print(f"  Total {len(merged)} elements after merge")
     
     # 5. Draw SoM marks
     print("\n[4/4] Drawing SoM marks...")
-    draw_som_marks(input_image, all_elements, output_image)
+    draw_som_marks(input_image, merged, output_image)
     
     # 6. Save JSON
+    all_elements = element_dicts(merged)
     with open(output_json, 'w', encoding='utf-8') as f:
         json.dump({
             'image': input_image,
@@ -0,0 +1,1697 @@
+"""
+OCR-SoM 共享核心
+
+server.py 和 ocr_som.py 共用的纯计算部分（不设置任何环境变量，可安全导入）：
+  - 框的向量化重叠计算
+  - NMS 去重
+  - 网格空间索引（OCR 框与轮廓框的重叠合并）
+  - 列式元素表（框 / 置信度 / 编号按 NumPy 数组存放，按需转为 dict 或紧凑格式）
+  - 图片输入（数组 / PIL / 字节 / 路径统一为 BGR 数组）
+  - 分阶段 OCR（检测 / 方向分类 / 识别），支持多张图片合并识别
+  - 超大图片分块 OCR
+  - LRU 结果缓存、文字识别缓存（按切片像素跳过识别）
+  - OCR 实例池（按优先级排队、队列上限和排队超时）
+  - 帧间差异检测（增量模式）
+  - 阶段线程池（OCR 与轮廓检测并行）
+  - 指标（阶段耗时直方图、Prometheus 文本导出）
+  - 耗时估算（按最近实测的每百万像素耗时，供时间预算选择处理策略）
+  - 轮廓检测预处理（共享梯度的多阈值 Canny、饱和度掩码、线程缓冲区）
+  - 标注绘制（编号标签 sprite 缓存、切片批量合成、标签避让）
+"""
+
+import os
+import json
+import time
+import heapq
+import bisect
+import hashlib
+import itertools
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+
+def as_boxes(boxes):
+    """将 [[x1, y1, x2, y2], ...] 转为 (N, 4) float64 数组"""
+    return np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def box_areas(boxes):
+    """计算 (N, 4) 框的面积"""
+    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+
+def intersection_matrix(boxes_a, boxes_b):
+    """
+    两组框两两之间的交集面积
+
+    返回: (len(a), len(b)) 数组，不相交为 0
+    """
+    a = as_boxes(boxes_a)
+    b = as_boxes(boxes_b)
+    iw = np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0])
+    ih = np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1])
+    return np.clip(iw, 0, None) * np.clip(ih, 0, None)
+
+
+def overlap_matrix(boxes_a, boxes_b, mode="iou"):
+    """
+    两组框两两之间的重叠率
+
+    mode:
+      - 'iou': 交集 / 并集
+      - 'a':   交集 / a 的面积（a 有多少被 b 覆盖）
+      - 'min': 交集 / 较小框的面积
+    """
+    a = as_boxes(boxes_a)
+    b = as_boxes(boxes_b)
+    inter = intersection_matrix(a, b)
+    area_a = box_areas(a)[:, None]
+    area_b = box_areas(b)[None, :]
+    if mode == "iou":
+        denom = area_a + area_b - inter
+    elif mode == "a":
+        denom = np.broadcast_to(area_a, inter.shape)
+    elif mode == "min":
+        denom = np.minimum(area_a, area_b)
+    else:
+        raise ValueError(f"未知的重叠模式: {mode}")
+    return np.divide(inter, denom, out=np.zeros_like(inter), where=denom > 0)
+
+
+def nms(boxes, iou_threshold=0.5, order=None, mode="iou"):
+    """
+    贪心 NMS 去重
+
+    按 order 给出的优先级（默认即输入顺序）依次保留框，
+    与已保留框重叠率 > iou_threshold 的后续框被抑制。
+    与逐个检查 seen_boxes 的写法结果一致，但每轮只做一次向量化计算。
+
+    mode: 'iou' 交集 / 并集；'min' 交集 / 较小框面积（用于去掉被包含的碎片）
+
+    返回: 保留框的下标（按优先级顺序）
+    """
+    b = as_boxes(boxes)
+    if order is None:
+        order = np.arange(len(b))
+    else:
+        order = np.asarray(order, dtype=np.intp)
+    x1, y1, x2, y2 = b[:, 0], b[:, 1], b[:, 2], b[:, 3]
+    areas = box_areas(b)
+
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        iw = np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest])
+        ih = np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest])
+        inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+        if mode == "min":
+            denom = np.minimum(areas[i], areas[rest])
+        else:
+            denom = areas[i] + areas[rest] - inter
+        iou = np.divide(inter, denom, out=np.zeros_like(inter), where=denom > 0)
+        order = rest[iou <= iou_threshold]
+    return np.asarray(keep, dtype=np.intp)
+
+
+class GridIndex:
+    """
+    均匀网格空间索引
+
+    每个框登记到它覆盖的所有网格中，查询时只与同网格内的框比较，
+    避免两组框全量两两比较。建表和查询都是批量的 NumPy 运算。
+    """
+
+    # 网格坐标编码为单个 int64: (gx + OFFSET) * STRIDE + (gy + OFFSET)
+    _OFFSET = 1 << 20
+    _STRIDE = 1 << 21
+
+    def __init__(self, boxes, cell_size=None):
+        self.boxes = as_boxes(boxes)
+        if cell_size is None:
+            cell_size = self._auto_cell_size(self.boxes)
+        self.cell_size = float(cell_size)
+        cells, owners = self._cover(self.boxes)
+        order = np.argsort(cells, kind="stable")
+        self._cells = cells[order]
+        self._owners = owners[order]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    @staticmethod
+    def _auto_cell_size(boxes):
+        """网格边长取框平均边长的中位数，至少 8 像素"""
+        if len(boxes) == 0:
+            return 64.0
+        sides = ((boxes[:, 2] - boxes[:, 0]) + (boxes[:, 3] - boxes[:, 1])) / 2
+        return max(8.0, float(np.median(sides)))
+
+    def _cover(self, boxes):
+        """枚举每个框覆盖的网格，返回 (cell_id, box_idx) 两个等长数组"""
+        if len(boxes) == 0:
+            return np.empty(0, np.int64), np.empty(0, np.intp)
+        c = np.floor(boxes / self.cell_size).astype(np.int64)
+        cx1, cy1 = c[:, 0], c[:, 1]
+        nx = np.maximum(c[:, 2] - cx1 + 1, 1)
+        ny = np.maximum(c[:, 3] - cy1 + 1, 1)
+        counts = nx * ny
+        owners = np.repeat(np.arange(len(boxes)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        gx = cx1[owners] + k % nx[owners]
+        gy = cy1[owners] + k // nx[owners]
+        cells = (gx + self._OFFSET) * self._STRIDE + (gy + self._OFFSET)
+        return cells, owners
+
+    def query_pairs(self, boxes):
+        """
+        批量查询可能相交的候选对
+
+        返回: (query_idx, box_idx)，每个候选对只出现一次
+        """
+        q = as_boxes(boxes)
+        qcells, qowners = self._cover(q)
+        lo = np.searchsorted(self._cells, qcells, side="left")
+        hi = np.searchsorted(self._cells, qcells, side="right")
+        counts = hi - lo
+        if counts.sum() == 0:
+            return np.empty(0, np.intp), np.empty(0, np.intp)
+        qi = np.repeat(qowners, counts)
+        pos = np.repeat(lo, counts) + (
+            np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        )
+        bi = self._owners[pos]
+        # 跨多个网格的框会重复出现，去重
+        pair = np.unique(qi.astype(np.int64) * len(self.boxes) + bi)
+        return (pair // len(self.boxes)).astype(np.intp), (pair % len(self.boxes)).astype(np.intp)
+
+    def query(self, box):
+        """查询与单个框可能相交的框下标"""
+        _, bi = self.query_pairs([box])
+        return bi
+
+
+def suppress_covered(boxes, cover_boxes, threshold=0.3, index=None):
+    """
+    找出被 cover_boxes 覆盖的框
+
+    通过 GridIndex 只比较空间上相邻的框对，可传入已建好的 index 复用。
+
+    返回: 布尔掩码，True 表示该框有超过 threshold 的面积落在某个 cover 框内
+    """
+    b = as_boxes(boxes)
+    covered = np.zeros(len(b), dtype=bool)
+    if index is None:
+        index = GridIndex(cover_boxes)
+    if len(b) == 0 or len(index) == 0:
+        return covered
+
+    qi, ci = index.query_pairs(b)
+    if len(qi) == 0:
+        return covered
+    a, c = b[qi], index.boxes[ci]
+    iw = np.minimum(a[:, 2], c[:, 2]) - np.maximum(a[:, 0], c[:, 0])
+    ih = np.minimum(a[:, 3], c[:, 3]) - np.maximum(a[:, 1], c[:, 1])
+    inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+    area = box_areas(a)
+    ratio = np.divide(inter, area, out=np.zeros_like(inter), where=area > 0)
+    covered[qi[ratio > threshold]] = True
+    return covered
+
+
+# ---------------------------------------------------------------------------
+# 元素表（列式存储）
+# ---------------------------------------------------------------------------
+
+ELEMENT_TYPES = ("text", "contour")
+TEXT, CONTOUR = 0, 1
+
+
+class ElementTable:
+    """
+    列式元素表
+
+    一组元素按列存放：ids (N,) int32、types (N,) uint8（ELEMENT_TYPES 下标）、
+    boxes (N, 4) int32、confidences (N,) float64（无置信度为 NaN）、texts 字符串列表，
+    以及可选的 polygons (N, 4, 2) int32。OCR 解析、轮廓检测、合并、绘制都直接
+    操作这些数组，只在返回给客户端时才转成每个元素一个 dict 的形式。
+    """
+
+    __slots__ = ("ids", "types", "boxes", "confidences", "texts", "polygons")
+
+    def __init__(self, boxes=(), types=TEXT, ids=None, confidences=None, texts=None, polygons=None):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        n = len(self.boxes)
+        self.types = np.broadcast_to(np.asarray(types, dtype=np.uint8), (n,)).copy()
+        self.ids = np.arange(n, dtype=np.int32) if ids is None else np.asarray(ids, dtype=np.int32).reshape(n)
+        if confidences is None:
+            self.confidences = np.full(n, np.nan)
+        else:
+            self.confidences = np.asarray(confidences, dtype=np.float64).reshape(n)
+        self.texts = [""] * n if texts is None else list(texts)
+        self.polygons = None if polygons is None else np.asarray(polygons, dtype=np.int32).reshape(n, 4, 2)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __repr__(self):
+        return f"ElementTable({len(self)} elements, {int(self.is_text.sum())} text)"
+
+    @property
+    def is_text(self):
+        return self.types == TEXT
+
+    @classmethod
+    def contours(cls, boxes):
+        """轮廓元素表"""
+        return cls(boxes, types=CONTOUR)
+
+    @classmethod
+    def from_ocr_lines(cls, lines):
+        """
+        解析 PaddleOCR 单张图片的结果 [[polygon, (text, score)], ...]（无文字时为 None）
+
+        四边形一次堆叠为 (N, 4, 2) 数组，外接框由向量化的 min / max 得到；
+        坐标截断为整数，score 为 None（只检测不识别）时置信度为 NaN。
+        """
+        lines = lines or []
+        polygons = np.asarray([line[0] for line in lines], dtype=np.float64).reshape(-1, 4, 2)
+        boxes = np.concatenate([polygons.min(axis=1), polygons.max(axis=1)], axis=1)
+        return cls(
+            boxes.astype(np.int32),
+            texts=[line[1][0] for line in lines],
+            confidences=np.array([line[1][1] for line in lines], dtype=np.float64),
+            polygons=polygons.astype(np.int32),
+        )
+
+    @classmethod
+    def from_dicts(cls, elements):
+        """由元素 dict 列表构造（type 不是 'text' 的都视为轮廓）"""
+        with_polygon = bool(elements) and all("polygon" in el for el in elements)
+        return cls(
+            boxes=[el["box"] for el in elements],
+            types=[TEXT if el.get("type") == "text" else CONTOUR for el in elements],
+            ids=[el.get("id", i) for i, el in enumerate(elements)],
+            confidences=[np.nan if el.get("confidence") is None else el["confidence"] for el in elements],
+            texts=[el.get("text", "") for el in elements],
+            polygons=[el["polygon"] for el in elements] if with_polygon else None,
+        )
+
+    @classmethod
+    def from_columns(cls, columns):
+        """由 to_columns() 的结果构造，数组列可以是列表或小端字节"""
+        def column(name, dtype):
+            value = columns[name]
+            if isinstance(value, (bytes, bytearray)):
+                return np.frombuffer(value, dtype=np.dtype(dtype).newbyteorder("<"))
+            return np.asarray([np.nan if v is None else v for v in value] if name == "confidence" else value,
+                              dtype=dtype)
+
+        polygons = column("polygon", np.int32) if columns.get("polygon") is not None else None
+        return cls(
+            boxes=column("box", np.int32),
+            types=[ELEMENT_TYPES.index(t) for t in columns["type"]],
+            ids=column("id", np.int32),
+            confidences=column("confidence", np.float32),
+            texts=columns["text"],
+            polygons=polygons,
+        )
+
+    @staticmethod
+    def concat(tables):
+        """按顺序拼接多个元素表（polygons 只在所有表都有时保留）"""
+        tables = list(tables)
+        if not tables:
+            return ElementTable()
+        with_polygon = all(t.polygons is not None for t in tables)
+        return ElementTable(
+            boxes=np.concatenate([t.boxes for t in tables]),
+            types=np.concatenate([t.types for t in tables]),
+            ids=np.concatenate([t.ids for t in tables]),
+            confidences=np.concatenate([t.confidences for t in tables]),
+            texts=[text for t in tables for text in t.texts],
+            polygons=np.concatenate([t.polygons for t in tables]) if with_polygon else None,
+        )
+
+    def take(self, index):
+        """按布尔掩码或下标数组取子表"""
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        return ElementTable(
+            boxes=self.boxes[index],
+            types=self.types[index],
+            ids=self.ids[index],
+            confidences=self.confidences[index],
+            texts=[self.texts[i] for i in index.tolist()],
+            polygons=self.polygons[index] if self.polygons is not None else None,
+        )
+
+    def translate(self, dx, dy):
+        """返回整体平移 (dx, dy) 后的新表"""
+        moved = self.take(np.arange(len(self)))
+        moved.boxes += np.array([dx, dy, dx, dy], dtype=np.int32)
+        if moved.polygons is not None:
+            moved.polygons += np.array([dx, dy], dtype=np.int32)
+        return moved
+
+    def to_dicts(self, with_polygon=False):
+        """转为元素 dict 列表（文字元素含 text / confidence，轮廓只有 box）"""
+        ids = self.ids.tolist()
+        boxes = self.boxes.tolist()
+        confidences = np.round(self.confidences, 4).tolist()
+        polygons = self.polygons.tolist() if with_polygon and self.polygons is not None else None
+        elements = []
+        for i, is_text in enumerate(self.is_text.tolist()):
+            if is_text:
+                conf = confidences[i]
+                el = {"id": ids[i], "type": "text", "text": self.texts[i],
+                      "confidence": None if conf != conf else conf, "box": boxes[i]}
+                if polygons is not None:
+                    el["polygon"] = polygons[i]
+            else:
+                el = {"id": ids[i], "type": ELEMENT_TYPES[self.types[i]], "box": boxes[i]}
+            elements.append(el)
+        return elements
+
+    def to_columns(self, binary=False, with_polygon=False):
+        """
+        转为列式 dict：id / type / text / confidence 各一个列表，box 为展平的
+        [x1, y1, x2, y2, x1, y1, ...]（polygon 同理，每个元素 8 个数）
+
+        binary=True 时数值列改为小端字节（id、box、polygon 为 int32，confidence 为 float32，
+        无置信度为 NaN），用于 MessagePack 等二进制格式，客户端可直接 frombuffer。
+        """
+        def pack(arr, dtype):
+            return np.ascontiguousarray(arr, dtype=np.dtype(dtype).newbyteorder("<")).tobytes()
+
+        if binary:
+            confidences = pack(self.confidences, np.float32)
+        else:
+            confidences = [None if c != c else c for c in np.round(self.confidences, 4).tolist()]
+        columns = {
+            "id": pack(self.ids, np.int32) if binary else self.ids.tolist(),
+            "type": [ELEMENT_TYPES[t] for t in self.types.tolist()],
+            "text": list(self.texts),
+            "confidence": confidences,
+            "box": pack(self.boxes, np.int32) if binary else self.boxes.ravel().tolist(),
+        }
+        if with_polygon and self.polygons is not None:
+            columns["polygon"] = pack(self.polygons, np.int32) if binary else self.polygons.ravel().tolist()
+        return columns
+
+
+# ---------------------------------------------------------------------------
+# 图片输入
+# ---------------------------------------------------------------------------
+
+def as_bgr_image(image):
+    """
+    把各种形式的图片统一为 uint8 BGR 数组
+
+    支持 numpy 数组（按 OpenCV 习惯视为 BGR / BGRA / 灰度）、PIL.Image（RGB 系）、
+    编码后的图片字节（PNG / JPEG 等）以及文件路径。无法解码时返回 None。
+    """
+    import cv2
+
+    if isinstance(image, np.ndarray):
+        img = image
+    elif isinstance(image, (bytes, bytearray, memoryview)):
+        img = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+    elif isinstance(image, (str, os.PathLike)):
+        # np.fromfile + imdecode 以支持 Windows 上的中文路径
+        try:
+            data = np.fromfile(str(image), dtype=np.uint8)
+        except OSError:
+            return None
+        img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    elif hasattr(image, "convert") and hasattr(image, "mode"):
+        # PIL.Image
+        rgb = np.asarray(image.convert("RGB"))
+        return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+    else:
+        raise TypeError(f"不支持的图片类型: {type(image).__name__}")
+
+    if img is None:
+        return None
+    if img.dtype != np.uint8:
+        raise TypeError(f"图片数组应为 uint8，实际为 {img.dtype}")
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return img
+
+
+# ---------------------------------------------------------------------------
+# 分阶段 OCR
+#
+# 与 PaddleOCR 2.7 的 TextSystem.__call__ 流程一致（检测 -> 排序 -> 切片 ->
+# 方向分类 -> 识别 -> 按 drop_score 过滤），但把各阶段拆开调用，
+# 以便多张图片的文字切片合并后一次送入识别模型。
+# ---------------------------------------------------------------------------
+
+def reading_order(polygons):
+    """按从上到下、从左到右排列的下标（左上角 y 相差 < 10 视为同一行）"""
+    idx = sorted(range(len(polygons)), key=lambda i: (polygons[i][0][1], polygons[i][0][0]))
+    for i in range(len(idx) - 1):
+        for j in range(i, -1, -1):
+            a, b = polygons[idx[j]][0], polygons[idx[j + 1]][0]
+            if abs(b[1] - a[1]) < 10 and b[0] < a[0]:
+                idx[j], idx[j + 1] = idx[j + 1], idx[j]
+            else:
+                break
+    return idx
+
+
+def sorted_boxes(dt_boxes):
+    """文字框按阅读顺序排序（与 PaddleOCR 一致）"""
+    return [dt_boxes[i] for i in reading_order(dt_boxes)]
+
+
+def crop_text_region(img, points):
+    """按四边形透视变换切出文字区域，竖排文字旋转为横排"""
+    import cv2
+
+    points = np.asarray(points, dtype=np.float32)
+    crop_w = int(max(np.linalg.norm(points[0] - points[1]), np.linalg.norm(points[2] - points[3])))
+    crop_h = int(max(np.linalg.norm(points[0] - points[3]), np.linalg.norm(points[1] - points[2])))
+    pts_std = np.float32([[0, 0], [crop_w, 0], [crop_w, crop_h], [0, crop_h]])
+    M = cv2.getPerspectiveTransform(points, pts_std)
+    crop = cv2.warpPerspective(
+        img, M, (crop_w, crop_h),
+        borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_CUBIC,
+    )
+    if crop.shape[0] * 1.0 / max(crop.shape[1], 1) >= 1.5:
+        crop = np.rot90(crop)
+    return crop
+
+
+def has_ocr_stages(engine):
+    """引擎是否暴露了 PaddleOCR 的分阶段接口"""
+    return hasattr(engine, "text_detector") and hasattr(engine, "text_recognizer")
+
+
+def detect_text(engine, img):
+    """文字检测，返回排序后的四边形列表"""
+    dt_boxes, _ = engine.text_detector(img)
+    if dt_boxes is None or len(dt_boxes) == 0:
+        return []
+    return sorted_boxes(dt_boxes)
+
+
+def recognize_crops(engine, crops, cls=True, metrics=None, cache=None):
+    """
+    对文字切片做方向分类（可选）和识别，返回 [(text, score), ...]
+
+    传入 cache（RecognitionCache）时先按切片像素查缓存，只有没见过的切片送入模型。
+    """
+    if not crops:
+        return []
+    use_cls = bool(cls and getattr(engine, "use_angle_cls", False) and engine.text_classifier is not None)
+
+    keys = None
+    results = [None] * len(crops)
+    if cache is not None:
+        with span(metrics, "ocr_rec_cache"):
+            keys = [cache.make_key(crop, use_cls) for crop in crops]
+            results = [cache.get(key) for key in keys]
+    pending = [i for i, res in enumerate(results) if res is None]
+    if not pending:
+        return results
+
+    batch = [crops[i] for i in pending]
+    if use_cls:
+        with span(metrics, "ocr_cls"):
+            batch, _, _ = engine.text_classifier(batch)
+    with span(metrics, "ocr_rec"):
+        rec_res, _ = engine.text_recognizer(batch)
+
+    for i, res in zip(pending, rec_res):
+        results[i] = res
+        if keys is not None:
+            cache.put(keys[i], res)
+    return results
+
+
+def run_ocr_batch(engine, images, cls=True, rec=True, metrics=None, rec_cache=None):
+    """
+    对多张图片运行 OCR
+
+    每张图片单独检测，所有文字切片合并后一次识别（识别模型内部按宽高比分批），
+    返回值与逐张调用 engine.ocr(img)[0] 一致：每张图片一个
+    [[polygon, (text, score)], ...] 列表，没有文字时为 None。
+
+    cls=False 跳过方向分类；rec=False 只做检测，返回的 text 为空、score 为 None。
+    metrics 不为 None 时分别记录检测 / 切片 / 方向分类 / 识别的耗时
+    （没有分阶段接口的引擎整体记为 ocr）。rec_cache 为 RecognitionCache 时
+    跳过识别过的文字切片（没有分阶段接口的引擎不使用）。
+    """
+    if not has_ocr_stages(engine):
+        results = []
+        for img in images:
+            with span(metrics, "ocr"):
+                result = engine.ocr(img, cls=cls, rec=rec)
+            lines = result[0] if result else None
+            if lines and not rec:
+                lines = [[poly, ("", None)] for poly in lines]
+            results.append(lines)
+        return results
+
+    with span(metrics, "ocr_det"):
+        all_boxes = [detect_text(engine, img) for img in images]
+    if not rec:
+        return [[[np.asarray(box).tolist(), ("", None)] for box in boxes] or None for boxes in all_boxes]
+
+    all_crops = []
+    with span(metrics, "ocr_crop"):
+        for img, boxes in zip(images, all_boxes):
+            all_crops.extend(crop_text_region(img, box) for box in boxes)
+
+    rec_res = recognize_crops(engine, all_crops, cls=cls, metrics=metrics, cache=rec_cache)
+
+    drop_score = getattr(engine, "drop_score", 0.5)
+    results = []
+    offset = 0
+    for boxes in all_boxes:
+        lines = []
+        for box, (text, score) in zip(boxes, rec_res[offset:offset + len(boxes)]):
+            if score >= drop_score:
+                lines.append([np.asarray(box).tolist(), (text, score)])
+        offset += len(boxes)
+        results.append(lines or None)
+    return results
+
+
+# ---------------------------------------------------------------------------
+# 分块 OCR
+#
+# 检测模型会把长边缩放到固定尺寸，多屏拼接的超大截图整张送入时小字会丢失。
+# 切成互相重叠的块分别识别，再平移回全图坐标并去掉接缝处的重复。
+# ---------------------------------------------------------------------------
+
+# 默认分块参数：块边长接近检测模型的缩放尺寸，重叠区足够容纳一行文字
+TILE_SIZE = 1280
+TILE_OVERLAP = 160
+TILE_AUTO_SIDE = 4096  # 自动模式下长边超过该值才分块
+
+
+def _axis_starts(length, tile, overlap):
+    """一维方向上各块的起点：块数取满足最小重叠的最少块数，起点均匀分布并贴齐两端"""
+    if length <= tile:
+        return [0]
+    step = max(1, tile - overlap)
+    n = max(2, -(-(length - overlap) // step))
+    return [round(i * (length - tile) / (n - 1)) for i in range(n)]
+
+
+def split_tiles(shape, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """把图片切成互相重叠的块，返回 [[x1, y1, x2, y2], ...]（按行优先）"""
+    h, w = shape[:2]
+    return [
+        [x, y, min(x + tile_size, w), min(y + tile_size, h)]
+        for y in _axis_starts(h, tile_size, overlap)
+        for x in _axis_starts(w, tile_size, overlap)
+    ]
+
+
+def _stitch_text(left, right):
+    """拼接被接缝切开的两段文字，去掉两段在重叠区内重复识别的部分"""
+    for k in range(min(len(left), len(right)), 0, -1):
+        if left.endswith(right[:k]):
+            return left + right[k:]
+    return left + right
+
+
+def merge_tile_lines(tile_results, tiles, shape, overlap_threshold=0.5, edge_margin=4):
+    """
+    合并各块的 OCR 结果
+
+    1. 坐标平移回全图
+    2. 被纵向接缝切开的同一行文字（左段贴着所在块的右边界、右段贴着所在块的左边界）
+       左右拼接，重叠区内重复识别的字去掉
+    3. 只在不同块之间去重：与另一块的框重叠（交集 / 较小框 > overlap_threshold）的
+       块边界残段，以及两块重叠区内与之几乎相同（IoU > overlap_threshold）的完整框，
+       按面积从大到小只保留最完整的那份；同一块内的框（包括相互嵌套、重叠的不同文字行）原样保留
+
+    返回: 与 run_ocr_batch 单张结果相同的格式，没有文字时为 None
+    """
+    img_h, img_w = shape[:2]
+    entries = []
+    for tile_id, ((tx1, ty1, tx2, ty2), lines) in enumerate(zip(tiles, tile_results)):
+        for poly, (text, score) in lines or []:
+            p = np.asarray(poly, dtype=np.float64) + [tx1, ty1]
+            box = np.array([p[:, 0].min(), p[:, 1].min(), p[:, 0].max(), p[:, 1].max()])
+            entries.append({
+                "box": box,
+                "text": text,
+                "score": score,
+                "polygon": p.tolist(),
+                "tile": tile_id,
+                "tiles": {tile_id},
+                "cut_left": tx1 > 0 and box[0] - tx1 <= edge_margin,
+                "cut_right": tx2 < img_w and tx2 - box[2] <= edge_margin,
+                "cut_y": (ty1 > 0 and box[1] - ty1 <= edge_margin) or (ty2 < img_h and ty2 - box[3] <= edge_margin),
+            })
+    if not entries:
+        return None
+
+    merged = []
+    for e in sorted(entries, key=lambda e: e["box"][0]):
+        target = None
+        if e["cut_left"]:
+            eb = e["box"]
+            for m in merged:
+                mb = m["box"]
+                same_row = min(mb[3], eb[3]) - max(mb[1], eb[1]) > 0.5 * min(mb[3] - mb[1], eb[3] - eb[1])
+                if (m["cut_right"] and m["tile"] != e["tile"] and same_row
+                        and mb[0] < eb[0] < mb[2] < eb[2]):
+                    target = m
+                    break
+        if target is None:
+            merged.append(e)
+            continue
+        tb = target["box"]
+        target["box"] = np.concatenate([np.minimum(tb[:2], e["box"][:2]), np.maximum(tb[2:], e["box"][2:])])
+        target["text"] = _stitch_text(target["text"], e["text"])
+        # 只做检测（rec=False）时没有置信度，任一段缺失则保持 None
+        scores = (target["score"], e["score"])
+        target["score"] = None if None in scores else min(scores)
+        target["tile"] = e["tile"]
+        target["tiles"] = target["tiles"] | e["tiles"]
+        target["cut_right"] = e["cut_right"]
+        target["cut_y"] = target["cut_y"] or e["cut_y"]
+        # 拼接后的行用外接矩形作为四边形
+        x1, y1, x2, y2 = target["box"].tolist()
+        target["polygon"] = [[x1, y1], [x2, y1], [x2, y2], [x1, y2]]
+
+    boxes = np.array([m["box"] for m in merged])
+    tile_boxes = as_boxes(tiles)
+    # 每个框所在块的范围（拼接后的行跨越两块，取外接矩形）
+    spans = np.array([
+        np.concatenate([tile_boxes[list(m["tiles"]), :2].min(axis=0), tile_boxes[list(m["tiles"]), 2:].max(axis=0)])
+        for m in merged
+    ])
+    overlap = overlap_matrix(boxes, boxes, mode="min")
+    iou = overlap_matrix(boxes, boxes)
+    areas = box_areas(boxes)
+    order = np.argsort(-areas, kind="stable")
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    removed = np.zeros(len(merged), dtype=bool)
+    for i in order:
+        if removed[i]:
+            continue
+        for j in np.flatnonzero((overlap[i] > overlap_threshold) & (rank > rank[i]) & ~removed):
+            if merged[i]["tiles"] & merged[j]["tiles"]:
+                continue
+            # 重复识别：被块边界切开的残段，或两块重叠区内几乎相同的完整框
+            # （嵌套在另一块的大框里的完整文字行不算，它在另一块里有自己的那份）
+            m = merged[j]
+            if m["cut_left"] or m["cut_right"] or m["cut_y"]:
+                removed[j] = True
+                continue
+            band = np.concatenate([np.maximum(spans[i, :2], spans[j, :2]), np.minimum(spans[i, 2:], spans[j, 2:])])
+            in_band = intersection_matrix(boxes[j:j + 1], band[None])[0, 0] > overlap_threshold * areas[j]
+            removed[j] = in_band and iou[i, j] > overlap_threshold
+    kept = [m for m, r in zip(merged, removed) if not r]
+    polygons = [m["polygon"] for m in kept]
+    return [[polygons[i], (kept[i]["text"], kept[i]["score"])] for i in reading_order(polygons)]
+
+
+def run_ocr_tiled(run_batch, img, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, workers=1):
+    """
+    分块 OCR
+
+    run_batch(crops) 对一组图片返回各自的 OCR 行列表（如 run_ocr_batch 的偏函数）。
+    workers > 1 时把块均分为 workers 组并行执行（run_batch 需可在多个线程中同时调用）。
+    """
+    tiles = split_tiles(img.shape, tile_size, overlap)
+    crops = [img[y1:y2, x1:x2].copy() for x1, y1, x2, y2 in tiles]
+    workers = max(1, min(workers, len(crops)))
+    groups = [list(range(i, len(crops), workers)) for i in range(workers)]
+
+    def work(group):
+        return run_batch([crops[i] for i in group])
+
+    if workers == 1:
+        group_results = [work(groups[0])]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, work, group) for group in groups]
+            group_results = [future.result() for future in futures]
+
+    tile_results = [None] * len(crops)
+    for group, results in zip(groups, group_results):
+        for i, lines in zip(group, results):
+            tile_results[i] = lines
+    return merge_tile_lines(tile_results, tiles, img.shape)
+
+
+# ---------------------------------------------------------------------------
+# 缓存
+# ---------------------------------------------------------------------------
+
+class LRUCache:
+    """线程安全的 LRU 缓存，按条目大小之和限制内存"""
+
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class ResultCache:
+    """
+    识别结果缓存：内存 LRU + 可选磁盘层
+
+    键由解码后的像素和生效的选项共同决定，值是 ElementTable（以列式 JSON 文本保存，
+    内存占用即文本长度）。磁盘层每个键一个 JSON 文件，超过 max_disk_entries
+    时删除最旧的文件。
+    """
+
+    # 缓存值的格式版本，参与缓存键：格式变化后旧的磁盘文件不再命中（由 _prune_disk 逐步清理）
+    FORMAT_VERSION = 2
+
+    def __init__(self, max_bytes=64 << 20, cache_dir=None, max_disk_entries=10000):
+        self.memory = LRUCache(max_bytes)
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_disk_entries = max_disk_entries
+        self.disk_hits = 0
+        self._disk_writes = 0
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.memory.max_bytes > 0 or self.cache_dir is not None
+
+    @staticmethod
+    def make_key(image, options):
+        """由图片像素和选项计算缓存键"""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(str((ResultCache.FORMAT_VERSION, image.shape, image.dtype.str)).encode())
+        h.update(memoryview(np.ascontiguousarray(image)).cast("B"))
+        h.update(json.dumps(options, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """返回缓存的 ElementTable，未命中返回 None"""
+        payload = self.memory.get(key)
+        if payload is not None:
+            return ElementTable.from_columns(json.loads(payload))
+        if not self.cache_dir:
+            return None
+        path = self.cache_dir / f"{key}.json"
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        # 磁盘文件可能被截断或损坏：解析失败时删除并按未命中处理，只把有效内容放进内存层
+        try:
+            payload = data.decode("utf-8")
+            columns = json.loads(payload)
+        except ValueError:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            return None
+        self.disk_hits += 1
+        self.memory.put(key, payload)
+        return ElementTable.from_columns(columns)
+
+    def put(self, key, table):
+        payload = json.dumps(table.to_columns(with_polygon=True), ensure_ascii=False)
+        self.memory.put(key, payload)
+        if self.cache_dir:
+            path = self.cache_dir / f"{key}.json"
+            # 临时文件名带进程号：多进程模式下各 worker 的线程号可能相同
+            tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_text(payload, encoding="utf-8")
+            os.replace(tmp, path)
+            self._disk_writes += 1
+            if self._disk_writes % 100 == 0:
+                self._prune_disk()
+
+    def _prune_disk(self):
+        """磁盘层超过上限时按修改时间删除最旧的文件"""
+        files = list(self.cache_dir.glob("*.json"))
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=lambda p: p.stat().st_mtime)
+        for path in files[:len(files) - self.max_disk_entries]:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats["disk"] = str(self.cache_dir) if self.cache_dir else None
+        stats["disk_hits"] = self.disk_hits
+        return stats
+
+
+class RecognitionCache:
+    """
+    文字识别结果缓存
+
+    菜单、标签、标题栏等文字在相邻帧里通常逐像素相同，检测后按切片像素哈希
+    查表即可跳过识别模型。键包含切片尺寸、像素和是否做了方向分类，值为 (text, score)，
+    按文字长度估算内存并以 LRU 淘汰。
+    """
+
+    ENTRY_OVERHEAD = 160  # 每条的键、元组和字典槽位的大致开销（字节）
+
+    def __init__(self, max_bytes=16 << 20):
+        self.memory = LRUCache(max_bytes, sizeof=lambda v: self.ENTRY_OVERHEAD + len(v[0].encode("utf-8")))
+
+    @property
+    def enabled(self):
+        return self.memory.max_bytes > 0
+
+    @staticmethod
+    def make_key(crop, cls):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{crop.shape}{crop.dtype.str}{int(cls)}".encode())
+        h.update(memoryview(np.ascontiguousarray(crop)).cast("B"))
+        return h.digest()
+
+    def get(self, key):
+        return self.memory.get(key)
+
+    def put(self, key, result):
+        text, score = result
+        self.memory.put(key, (text, float(score)))
+
+    def stats(self):
+        return self.memory.stats()
+
+
+# ---------------------------------------------------------------------------
+# OCR 实例池
+# ---------------------------------------------------------------------------
+
+class QueueFullError(RuntimeError):
+    """等待 OCR 实例的队列已满"""
+
+
+class QueueTimeoutError(TimeoutError):
+    """排队等待 OCR 实例超时"""
+
+
+class OCRPool:
+    """
+    OCR 实例池
+
+    每个请求独占一个实例，用完归还；实例按需创建，最多 size 个。
+    检测阈值等参数只在独占期间修改（见 detector_params），请求之间互不影响。
+
+    没有空闲实例时按 (priority, 到达顺序) 排队，priority 小的先获得实例。
+    max_waiting 为每个优先级最多排队的请求数（None 不限），超出时抛出 QueueFullError；
+    排队超过 timeout 秒抛出 QueueTimeoutError。过载时快速失败，而不是让所有请求一起变慢。
+    priority_names 为各优先级对外的名称（按 priority 下标），用于错误信息。
+    已持有实例的请求可用 try_acquire 顺带占用其余空闲实例（不排队）。
+    """
+
+    def __init__(self, factory, size=1, max_waiting=None, priority_names=None):
+        self._factory = factory
+        self.size = max(1, int(size))
+        self.max_waiting = max_waiting
+        self.priority_names = priority_names
+        self._idle = []
+        self._created = 0
+        self._cond = threading.Condition()
+        self._waiters = []  # (priority, 序号) 小顶堆，堆顶下一个获得实例
+        self._seq = itertools.count()
+        self._waiting = {}  # 优先级 -> 排队数
+        self._rejected = {"full": 0, "timeout": 0}
+
+    @contextmanager
+    def acquire(self, timeout=None, priority=0):
+        """独占一个实例，没有空闲实例时排队等待"""
+        engine = self._checkout(timeout, priority)
+        try:
+            yield engine
+        finally:
+            self._checkin(engine)
+
+    @contextmanager
+    def try_acquire(self):
+        """
+        有空闲实例且没有请求在排队时独占一个，否则 yield None（不等待）
+
+        供已持有实例的请求把分块识别分给其余空闲实例：不排队，不受 max_waiting 和超时限制，
+        也不会抢在排队中的请求之前；持有实例时不等待其他实例，不会互相死锁。
+        """
+        engine = self._checkout(wait=False)
+        try:
+            yield engine
+        finally:
+            if engine is not None:
+                self._checkin(engine)
+
+    def admit(self, priority=0):
+        """
+        准入检查：该优先级的队列已满时抛出 QueueFullError（不占位），否则返回其当前排队数
+
+        在开始处理请求前调用，避免先做了解码、轮廓检测等工作再在排队时被拒绝。
+        """
+        with self._cond:
+            self._check_queue(priority)
+            return self._waiting.get(priority, 0)
+
+    def _check_queue(self, priority):
+        if self.max_waiting is not None and self._waiting.get(priority, 0) >= self.max_waiting:
+            self._rejected["full"] += 1
+            name = self.priority_names[priority] if self.priority_names else priority
+            raise QueueFullError(f"OCR 等待队列已满（优先级 {name}，{self.max_waiting} 个请求）")
+
+    def _has_capacity(self):
+        return bool(self._idle) or self._created < self.size
+
+    def _checkout(self, timeout=None, priority=0, wait=True):
+        with self._cond:
+            if self._waiters or not self._has_capacity():
+                if not wait:
+                    return None
+                self._wait_turn(timeout, priority)
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        try:
+            return self._factory()
+        except BaseException:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify_all()
+            raise
+
+    def _wait_turn(self, timeout, priority):
+        """排队直到排在队首且有可用实例（调用方持有锁）"""
+        self._check_queue(priority)
+        ticket = (priority, next(self._seq))
+        heapq.heappush(self._waiters, ticket)
+        self._waiting[priority] = self._waiting.get(priority, 0) + 1
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while self._waiters[0] != ticket or not self._has_capacity():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._rejected["timeout"] += 1
+                    raise QueueTimeoutError(f"等待 OCR 实例超时（{timeout:g}s）")
+                self._cond.wait(remaining)
+        finally:
+            if self._waiters[0] == ticket:
+                heapq.heappop(self._waiters)
+            else:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+            self._waiting[priority] -= 1
+            # 队首变化，其余排队者重新检查
+            self._cond.notify_all()
+
+    def _checkin(self, engine):
+        with self._cond:
+            self._idle.append(engine)
+            self._cond.notify_all()
+
+    def warm(self):
+        """预先创建全部实例"""
+        engines = [self._checkout() for _ in range(self.size)]
+        for engine in engines:
+            self._checkin(engine)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "idle": len(self._idle),
+                "busy": self._created - len(self._idle),
+                "waiting": {p: n for p, n in sorted(self._waiting.items()) if n},
+                "max_waiting": self.max_waiting,
+                "rejected": dict(self._rejected),
+            }
+
+
+# 请求级检测参数名 -> DB 后处理器属性名
+DET_PARAM_ATTRS = {
+    "det_db_thresh": "thresh",
+    "det_db_box_thresh": "box_thresh",
+    "det_db_unclip_ratio": "unclip_ratio",
+    "min_text_size": "min_size",
+}
+
+
+@contextmanager
+def detector_params(engine, options):
+    """
+    在独占的实例上临时应用检测参数，退出时恢复原值
+
+    options 中为 None 的参数保持实例默认值。
+    """
+    postprocess_op = getattr(getattr(engine, "text_detector", None), "postprocess_op", None)
+    saved = {}
+    if postprocess_op is not None:
+        for key, attr in DET_PARAM_ATTRS.items():
+            value = options.get(key)
+            if value is not None and hasattr(postprocess_op, attr):
+                saved[attr] = getattr(postprocess_op, attr)
+                setattr(postprocess_op, attr, value)
+    try:
+        yield engine
+    finally:
+        for attr, value in saved.items():
+            setattr(postprocess_op, attr, value)
+
+
+# ---------------------------------------------------------------------------
+# 帧间差异（增量模式）
+# ---------------------------------------------------------------------------
+
+def changed_tiles(prev, curr, tile=32, threshold=16):
+    """
+    逐块比较两帧
+
+    返回: (rows, cols) 布尔网格，True 表示该块内有像素差异超过 threshold
+    """
+    import cv2
+
+    diff = cv2.absdiff(prev, curr)
+    if diff.ndim == 3:
+        diff = diff.max(axis=2)
+    h, w = diff.shape
+    rows, cols = -(-h // tile), -(-w // tile)
+    padded = np.zeros((rows * tile, cols * tile), dtype=diff.dtype)
+    padded[:h, :w] = diff
+    return padded.reshape(rows, tile, cols, tile).max(axis=(1, 3)) > threshold
+
+
+def tile_regions(mask, tile, shape, pad_tiles=1):
+    """
+    把变化块合并为矩形区域
+
+    相邻（含对角）的变化块归为同一区域，每个区域向外扩展 pad_tiles 块。
+    返回: 像素坐标的 [[x1, y1, x2, y2], ...]
+    """
+    import cv2
+
+    grid = mask.astype(np.uint8)
+    if pad_tiles:
+        grid = cv2.dilate(grid, np.ones((2 * pad_tiles + 1, 2 * pad_tiles + 1), np.uint8))
+    _, _, stats, _ = cv2.connectedComponentsWithStats(grid, connectivity=8)
+    h, w = shape[:2]
+    return [
+        [int(x * tile), int(y * tile), int(min((x + cw) * tile, w)), int(min((y + ch) * tile, h))]
+        for x, y, cw, ch, _ in stats[1:]
+    ]
+
+
+def expand_regions(regions, boxes=()):
+    """
+    让区域完整包含与其相交的框，并合并相互重叠的区域，直到不再变化
+
+    保证被区域切到的文字或图标会整体重新识别。
+    """
+    rs = as_boxes(regions).copy()
+    bs = as_boxes(boxes)
+    while True:
+        before = rs.copy()
+
+        if len(bs) and len(rs):
+            hit = intersection_matrix(rs, bs) > 0
+            for i in np.flatnonzero(hit.any(axis=1)):
+                sel = bs[hit[i]]
+                rs[i, :2] = np.minimum(rs[i, :2], sel[:, :2].min(axis=0))
+                rs[i, 2:] = np.maximum(rs[i, 2:], sel[:, 2:].max(axis=0))
+
+        merged = []
+        for r in rs:
+            for m in merged:
+                if r[0] < m[2] and r[2] > m[0] and r[1] < m[3] and r[3] > m[1]:
+                    m[:2] = np.minimum(m[:2], r[:2])
+                    m[2:] = np.maximum(m[2:], r[2:])
+                    break
+            else:
+                merged.append(r.copy())
+        rs = np.asarray(merged, dtype=np.float64).reshape(-1, 4)
+
+        if rs.shape == before.shape and (rs == before).all():
+            return rs.astype(int).tolist()
+
+
+# ---------------------------------------------------------------------------
+# 阶段线程池
+# ---------------------------------------------------------------------------
+
+class StageExecutor:
+    """
+    带队列深度统计的阶段线程池
+
+    OpenCV / Paddle 推理会释放 GIL，不同阶段放在各自的线程池中可真正并行，
+    queued / running 反映该阶段的积压情况。
+    """
+
+    def __init__(self, name, workers):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.name = name
+        self.workers = max(1, int(workers))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"som-{name}")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """提交任务，返回 Future（任务在提交者的 contextvars 上下文中运行）"""
+        context = contextvars.copy_context()
+        with self._lock:
+            self.queued += 1
+
+        def run():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return self._executor.submit(context.run, run)
+
+    def run(self, fn, *args, **kwargs):
+        """提交任务并等待结果"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+            }
+
+
+# ---------------------------------------------------------------------------
+# 指标
+# ---------------------------------------------------------------------------
+
+# 耗时直方图的桶上界（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 当前请求的耗时明细（StageExecutor 把提交者的上下文带到工作线程）
+_current_trace = contextvars.ContextVar("som_trace", default=None)
+
+
+class Histogram:
+    """累积直方图：每个桶统计 <= 上界的样本数，最后一个桶为 +Inf"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Trace:
+    """一个请求内各阶段的累计耗时（秒），多线程安全"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def as_ms(self):
+        with self._lock:
+            return {stage: round(seconds * 1000, 2) for stage, seconds in self.spans.items()}
+
+
+class Metrics:
+    """
+    进程内指标，按 Prometheus 文本格式导出
+
+    计数器、仪表盘、直方图以 (名称, 标签) 区分，名称需先用 describe() 声明类型。
+    span(stage) 把一段代码的耗时记入 <prefix>_stage_seconds{stage=...}，
+    同时累加到当前请求的 Trace（若有）。
+    """
+
+    def __init__(self, prefix="som"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._meta = {}    # 名称 -> (类型, 说明, 桶)
+        self._values = {}  # 名称 -> {标签元组: 数值或 Histogram}
+        self.describe("stage_seconds", "histogram", "各处理阶段耗时（秒）")
+
+    def describe(self, name, kind, help_text, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            self._meta[name] = (kind, help_text, buckets)
+            self._values.setdefault(name, {})
+
+    def _series(self, name, labels):
+        if name not in self._meta:
+            raise KeyError(f"未声明的指标: {name}")
+        return self._values[name], tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            series, key = self._series(name, labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            series, key = self._series(name, labels)
+            series[key] = value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            series, key = self._series(name, labels)
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = Histogram(self._meta[name][2])
+            hist.observe(value)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("stage_seconds", elapsed, stage=stage)
+            trace = _current_trace.get()
+            if trace is not None:
+                trace.add(stage, elapsed)
+
+    @staticmethod
+    def start_trace():
+        """在当前上下文中开始收集耗时明细，返回 (Trace, token)，token 交给 end_trace"""
+        trace = Trace()
+        return trace, _current_trace.set(trace)
+
+    @staticmethod
+    def end_trace(token):
+        _current_trace.reset(token)
+
+    @contextmanager
+    def trace(self):
+        """在 with 块内收集耗时明细，yield Trace"""
+        trace, token = self.start_trace()
+        try:
+            yield trace
+        finally:
+            self.end_trace(token)
+
+    def render(self, extra=()):
+        """
+        导出 Prometheus 文本格式
+
+        extra: 额外的 (名称, 类型, 说明, [(标签字典, 数值), ...])，用于导出时才读取的统计
+        """
+        with self._lock:
+            families = [
+                (name, kind, help_text, [
+                    (dict(key), value if kind != "histogram" else _copy_histogram(value))
+                    for key, value in sorted(self._values[name].items())
+                ])
+                for name, (kind, help_text, _) in self._meta.items()
+            ]
+        lines = []
+        for name, kind, help_text, samples in families + list(extra):
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} {kind}")
+            for labels, value in samples:
+                if kind != "histogram":
+                    lines.append(f"{full}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets + (float("inf"),), value.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else _format_value(bound)
+                    lines.append(f"{full}_bucket{_format_labels(dict(labels, le=le))} {cumulative}")
+                lines.append(f"{full}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+                lines.append(f"{full}_count{_format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def span(metrics, stage):
+    """metrics 为 None 时不计时"""
+    if metrics is None:
+        yield
+    else:
+        with metrics.span(stage):
+            yield
+
+
+def _copy_histogram(hist):
+    copy = Histogram(hist.buckets)
+    copy.counts, copy.sum, copy.count = list(hist.counts), hist.sum, hist.count
+    return copy
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items()) + "}"
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+# ---------------------------------------------------------------------------
+# 耗时估算
+# ---------------------------------------------------------------------------
+
+class CostModel:
+    """
+    按最近实测耗时估算各阶段开销
+
+    每个阶段记录“每百万像素毫秒数”的指数滑动平均（alpha 越大越看重最近的请求），
+    尚无实测数据的阶段使用 priors 中的先验值。多线程安全。
+    """
+
+    def __init__(self, priors, alpha=0.2):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._rates = dict(priors)
+        self._samples = dict.fromkeys(priors, 0)
+
+    def observe(self, stage, ms, megapixels):
+        """记录一次实测：该阶段处理 megapixels 百万像素耗时 ms 毫秒"""
+        if megapixels <= 0:
+            return
+        rate = ms / megapixels
+        with self._lock:
+            if not self._samples.get(stage):
+                self._rates[stage] = rate
+            else:
+                self._rates[stage] += self.alpha * (rate - self._rates[stage])
+            self._samples[stage] = self._samples.get(stage, 0) + 1
+
+    def estimate(self, stage, megapixels):
+        """估算处理 megapixels 百万像素的耗时（毫秒），既无实测也无先验的阶段返回 None"""
+        with self._lock:
+            rate = self._rates.get(stage)
+        return None if rate is None else rate * megapixels
+
+    def stats(self):
+        with self._lock:
+            return {
+                stage: {"ms_per_mp": round(rate, 2), "samples": self._samples.get(stage, 0)}
+                for stage, rate in self._rates.items()
+            }
+
+
+# ---------------------------------------------------------------------------
+# 轮廓检测预处理
+# ---------------------------------------------------------------------------
+
+class ScratchPool:
+    """
+    按线程复用的整帧临时缓冲区
+
+    每个阶段线程各自持有一组按名字区分的数组，尺寸和类型不变时直接复用，
+    避免每次请求都重新分配多个整帧数组。返回的数组只在当前调用内有效。
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self, name, shape, dtype=np.uint8):
+        buffers = self._local.__dict__.setdefault("buffers", {})
+        buf = buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = buffers[name] = np.empty(shape, dtype=dtype)
+        return buf
+
+    def nbytes(self):
+        """当前线程持有的缓冲区总字节数"""
+        return sum(buf.nbytes for buf in self._local.__dict__.get("buffers", {}).values())
+
+
+def edge_maps(gray, thresholds, scratch):
+    """
+    一次计算梯度，按多组 (low, high) 阈值生成 Canny 边缘图
+
+    Sobel 梯度（3x3，边界复制）与 cv2.Canny 内部计算完全一致，结果逐像素相同，
+    省去每组阈值重复求梯度。逐个 yield 边缘图，复用同一块缓冲区。
+    """
+    import cv2
+
+    dx = scratch.get("dx", gray.shape, np.int16)
+    dy = scratch.get("dy", gray.shape, np.int16)
+    cv2.spatialGradient(gray, dx, dy, 3, cv2.BORDER_REPLICATE)
+    edges = scratch.get("edges", gray.shape)
+    for low, high in thresholds:
+        cv2.Canny(dx, dy, low, high, edges=edges)
+        yield edges
+
+
+def _saturation_lut(threshold):
+    """
+    每个亮度 V 对应的最小色度阈值，S > threshold 等价于 (V - min) >= lut[V]
+
+    与 OpenCV 8 位 BGR2HSV 的定点运算一致：sdiv[V] = round((255 << 12) / V)，
+    S = ((V - min) * sdiv[V] + (1 << 11)) >> 12（V 为 0 时 S 为 0）。
+    """
+    v = np.arange(256)
+    sdiv = np.zeros(256, dtype=np.int64)
+    sdiv[1:] = np.rint((255 << 12) / v[1:])
+    # S > t  <=>  diff * sdiv >= ((t + 1) << 12) - (1 << 11)
+    need = ((int(np.floor(threshold)) + 1) << 12) - (1 << 11)
+    lut = np.full(256, 256, dtype=np.int64)
+    lut[1:] = -(-need // sdiv[1:])  # 向上取整
+    # 色度不超过 V：达不到的阈值取 V + 1（永不满足）
+    return np.minimum(lut, v + 1).clip(0, 255).astype(np.uint8)
+
+
+def saturation_mask(img, threshold, scratch):
+    """
+    高饱和度掩码（等价于 HSV 的 S 通道 > threshold）
+
+    只需要 S 通道，不做完整 HSV 转换：逐通道取 max / min 得到亮度和色度，
+    再查表比较，全程 uint8。返回值为 0/255 掩码，位于 scratch 缓冲区中。
+    """
+    import cv2
+
+    shape = img.shape[:2]
+    if threshold >= 255:
+        mask = scratch.get("sat_mask", shape)
+        mask.fill(0)
+        return mask
+    planes = [scratch.get(f"plane{i}", shape) for i in range(3)]
+    cv2.split(img, planes)
+    vmax = scratch.get("vmax", shape)
+    chroma = scratch.get("chroma", shape)
+    cv2.max(planes[0], planes[1], dst=vmax)
+    cv2.max(vmax, planes[2], dst=vmax)
+    cv2.min(planes[0], planes[1], dst=chroma)
+    cv2.min(chroma, planes[2], dst=chroma)
+    cv2.subtract(vmax, chroma, dst=chroma)
+    # 复用 plane0 存放逐像素阈值
+    cv2.LUT(vmax, _saturation_lut(threshold), dst=planes[0])
+    mask = scratch.get("sat_mask", shape)
+    cv2.compare(chroma, planes[0], cv2.CMP_GE, dst=mask)
+    return mask
+
+
+# ---------------------------------------------------------------------------
+# 标注绘制
+# ---------------------------------------------------------------------------
+
+LABEL_GRID = 4  # 标签避让的占位网格（像素）
+
+
+def hershey_label(label, font_scale=0.5, thickness=1):
+    """用 OpenCV Hershey 字体渲染编号，返回 uint8 覆盖度掩码（文字 255，四周留 3px 边距）"""
+    import cv2
+
+    (tw, th), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+    mask = np.zeros((th + 7, tw + 7), dtype=np.uint8)
+    cv2.putText(mask, label, (3, th + 3), cv2.FONT_HERSHEY_SIMPLEX, font_scale, 255, thickness)
+    return mask
+
+
+class MarkRenderer:
+    """
+    批量绘制 SoM 标注（彩色框 + 编号标签）
+
+    标签按编号预渲染成 sprite（底色 + 文字）放进 LRU 缓存，绘制时直接切片贴到
+    图片数组上，不再逐个测量、绘制文字；框线按颜色分组，每种颜色一次绘制。
+    标签默认放在框外左上角；与更早标签相交的（网格索引批量找出）再依次尝试
+    框内左上、框外左下、框外右上、框内右上，选第一个不与已放置标签重叠的位置
+    （占位记录在 LABEL_GRID 粗网格上）。
+
+    colors 与图片数组通道顺序一致（BGR 图传 BGR 颜色），render_label(label)
+    返回文字的 uint8 覆盖度掩码，掩码尺寸即标签尺寸。
+    """
+
+    def __init__(self, colors, render_label=hershey_label, thickness=2, text_color=(255, 255, 255),
+                 max_sprite_bytes=8 << 20):
+        self.colors = np.asarray(colors, dtype=np.uint8)
+        self.render_label = render_label
+        self.thickness = thickness
+        self.text_color = np.asarray(text_color, dtype=np.float32)
+        self._sprites = LRUCache(max_sprite_bytes, sizeof=lambda a: a.nbytes)
+
+    def sprite(self, el_id):
+        """编号 el_id 的标签图块 (h, w, 3) uint8"""
+        tile = self._sprites.get(el_id)
+        if tile is None:
+            alpha = self.render_label(str(el_id)).astype(np.float32)[..., None] / 255
+            color = self.colors[el_id % len(self.colors)].astype(np.float32)
+            tile = (color * (1 - alpha) + self.text_color * alpha + 0.5).astype(np.uint8)
+            self._sprites.put(el_id, tile)
+        return tile
+
+    def place_labels(self, boxes, sizes, shape):
+        """为每个框选择标签左上角位置，返回 (N, 2) 数组 [x, y]"""
+        img_h, img_w = shape[:2]
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+        w, h = sizes[:, 0], sizes[:, 1]
+        x1, y1, x2, y2 = boxes.T
+        candidates = np.stack([
+            np.stack([x1, y1 - h], axis=1),
+            np.stack([x1, y1], axis=1),
+            np.stack([x1, y2 + 1], axis=1),
+            np.stack([x2 - w + 1, y1 - h], axis=1),
+            np.stack([x2 - w + 1, y1], axis=1),
+        ], axis=1)
+        candidates[..., 0] = np.clip(candidates[..., 0], 0, np.maximum(img_w - w, 0)[:, None])
+        candidates[..., 1] = np.clip(candidates[..., 1], 0, np.maximum(img_h - h, 0)[:, None])
+
+        import cv2
+
+        # 默认位置不与任何更早标签相交的直接采用，只对冲突的标签逐个挑选位置
+        first = np.concatenate([candidates[:, 0], candidates[:, 0] + sizes], axis=1)
+        qi, bi = GridIndex(first).query_pairs(first)
+        a, c = first[qi], first[bi]
+        hit = ((bi < qi) & (np.minimum(a[:, 2], c[:, 2]) > np.maximum(a[:, 0], c[:, 0]))
+               & (np.minimum(a[:, 3], c[:, 3]) > np.maximum(a[:, 1], c[:, 1])))
+        conflict = np.zeros(len(boxes), dtype=bool)
+        conflict[qi[hit]] = True
+
+        g = LABEL_GRID
+        cells = np.concatenate([candidates // g, (candidates + sizes[:, None, :] + g - 1) // g], axis=2)
+        occupied = np.zeros(((img_h + g - 1) // g + 1, (img_w + g - 1) // g + 1), dtype=np.uint8)
+        for cx1, cy1, cx2, cy2 in cells[~conflict, 0].tolist():
+            occupied[cy1:cy2, cx1:cx2] = 1
+        chosen = np.zeros(len(boxes), dtype=np.intp)
+        for i in np.flatnonzero(conflict).tolist():
+            options = cells[i].tolist()
+            for k, (cx1, cy1, cx2, cy2) in enumerate(options):
+                if not cv2.countNonZero(occupied[cy1:cy2, cx1:cx2]):
+                    chosen[i] = k
+                    break
+            cx1, cy1, cx2, cy2 = options[chosen[i]]
+            occupied[cy1:cy2, cx1:cx2] = 1
+        return candidates[np.arange(len(boxes)), chosen]
+
+    def draw(self, img, ids, boxes):
+        """在 img（H, W, 3 uint8）上原地绘制标注并返回 img；boxes 为 [x1, y1, x2, y2]（含右下角）"""
+        import cv2
+
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        if not len(ids):
+            return img
+
+        # 框线：粗细 t 拆成 t 个逐像素内缩的 1px 框，同色的框一次 polylines 画完
+        rings = np.concatenate([boxes + [k, k, -k, -k] for k in range(self.thickness)])
+        ring_colors = np.tile(ids % len(self.colors), self.thickness)
+        valid = (rings[:, 2] >= rings[:, 0]) & (rings[:, 3] >= rings[:, 1])
+        rings, ring_colors = rings[valid], ring_colors[valid]
+        x1, y1, x2, y2 = rings.T
+        quads = np.stack([x1, y1, x2, y1, x2, y2, x1, y2], axis=1).reshape(-1, 4, 2).astype(np.int32)
+        for c in np.unique(ring_colors).tolist():
+            cv2.polylines(img, list(quads[ring_colors == c]), True, self.colors[c].tolist(), 1)
+
+        # 标签：放在所有框线之上，避免被后画的框盖住
+        tiles = [self.sprite(el_id) for el_id in ids.tolist()]
+        sizes = [(tile.shape[1], tile.shape[0]) for tile in tiles]
+        for (lx, ly), tile in zip(self.place_labels(boxes, sizes, img.shape).tolist(), tiles):
+            region = img[ly:ly + tile.shape[0], lx:lx + tile.shape[1]]
+            region[...] = tile[:region.shape[0], :region.shape[1]]
+        return img
@@ -0,0 +1,34 @@
+"""分块 OCR 合并（merge_tile_lines / run_ocr_tiled）"""
+
+import numpy as np
+
+from som_core import run_ocr_tiled, split_tiles
+
+
+def detect_dark(crops):
+    """只做检测的假 OCR：每块返回暗色像素的外接框，text 为空、score 为 None（同 rec=False）"""
+    results = []
+    for crop in crops:
+        ys, xs = np.nonzero(crop.min(axis=2) < 128)
+        if not len(xs):
+            results.append(None)
+            continue
+        x1, y1, x2, y2 = int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+        results.append([[[[x1, y1], [x2, y1], [x2, y2], [x1, y2]], ("", None)]])
+    return results
+
+
+def test_tiled_det_only_stitches_line_across_seam():
+    img = np.full((2160, 7680, 3), 255, dtype=np.uint8)
+    x1, x2 = 1000, 1500
+    img[100:130, x1:x2] = 0
+    tiles = split_tiles(img.shape)
+    assert any(tx1 < x1 < tx2 < x2 for tx1, _, tx2, _ in tiles)
+
+    lines = run_ocr_tiled(detect_dark, img, workers=2)
+
+    assert len(lines) == 1
+    polygon, (text, score) = lines[0]
+    assert (text, score) == ("", None)
+    xs = [p[0] for p in polygon]
+    assert (min(xs), max(xs)) == (x1, x2)